@@ -3,64 +3,127 @@ project_endpoint = "your-project-endpoint"
 model = "your-model-name"  
 deep_research_model = "o3-deep-research"  
 bing_grounding_connection_name = "bing-with-grounding-search-connection-name"  
+agent_cache_file = ".agent_cache.json"  # agent/thread IDs reused across runs  
 
 #import libraries
 # 
-# Note: I'm using Default Credentials, you can change that to managed identity by providing client ID or objet ID.  
-from azure.identity import DefaultAzureCredential  
-from azure.ai.projects import AIProjectClient  # Hypothetical import - please replace with the actual SDK if different  
+import argparse  
+import asyncio  
+import json  
+import os  
+import sys  
+from azure.core.exceptions import ResourceNotFoundError  
+# Note: set AZURE_CLIENT_ID to use a managed identity in Azure; locally the Azure CLI login is used.  
+from azure.identity.aio import AzureCliCredential, ManagedIdentityCredential  
+from azure.ai.projects.aio import AIProjectClient  # async client, so the long run does not block the event loop  
 from azure.ai.agents.models import DeepResearchTool, MessageRole
-from azure.ai.agents.models import AgentEventHandler, MessageRole
+from azure.ai.agents.models import AsyncAgentEventHandler, ListSortOrder, MessageRole
 
 #custom handler
-class MyEventHandler(AgentEventHandler):
-    def on_message_delta(self, delta):
+class MyEventHandler(AsyncAgentEventHandler):
+    async def on_message_delta(self, delta):
         # Print streamed text as it's received
         if hasattr(delta.content, "text"):
             print(delta.content.text.value, end="", flush=True)
 
-    def on_run_step(self, step):
-        # Notify when a tool is invoked
-        print(f"\n[Tool call: {step.type}]")
-        if step.step_details and hasattr(step.step_details, "tool_calls"):
-            for call in step.step_details.tool_calls:
-                print(f" → {call.tool_label}: {call.status}")
+    async def on_run_step(self, step):
+        # Notify when a tool is invoked (steps without tool calls only print the header)
+        lines = [f"\n[Tool call: {step.type}]"]
+        try:
+            lines.extend(f" → {call.tool_label}: {call.status}" for call in step.step_details.tool_calls or ())
+        except AttributeError:
+            pass
+        sys.stdout.write("\n".join(lines) + "\n")
+        sys.stdout.flush()
 
-    def on_done(self):
+    async def on_done(self):
         # Final callback after the run completes
         print("\n✅ Agent run complete.")
 
 
-with AIProjectClient(  
-    endpoint=project_endpoint,  
-    credential=DefaultAzureCredential(),  
-) as project_client:  
-  
-    # Get properties of the Bing Grounding connection in your Foundry project  
-    connection = project_client.connections.get(name=bing_grounding_connection_name)  
-  
-    # Initialize a Deep Research tool  
-    deep_research_tool = DeepResearchTool(  
-        bing_grounding_connection_id=connection.id,  
-        deep_research_model=deep_research_model,  
-    )  
-  
-    with project_client.agents as agents_client:  
+#agent/thread cache helpers
+def load_agent_cache():
+    if not os.path.exists(agent_cache_file):
+        return {}
+    with open(agent_cache_file) as f:
+        return json.load(f)
+
+
+def save_agent_cache(cache):
+    with open(agent_cache_file, "w") as f:
+        json.dump(cache, f)
+
+
+def make_credential():
+    # Managed identity when AZURE_CLIENT_ID is set, otherwise the local Azure CLI login
+    if os.getenv("AZURE_CLIENT_ID"):
+        return ManagedIdentityCredential(client_id=os.environ["AZURE_CLIENT_ID"])
+    return AzureCliCredential()
+
+
+async def resolve_bing_conn_id(project_client):
+    # The connection ID is stable: take it from BING_CONN_ID or the cache before asking Foundry
+    key = f"{project_endpoint}|{bing_grounding_connection_name}"
+    conn_id = os.environ.get("BING_CONN_ID") or cache.get("bing_conn_ids", {}).get(key)
+    if not conn_id:
+        conn_id = (await project_client.connections.get(name=bing_grounding_connection_name)).id
+        cache.setdefault("bing_conn_ids", {})[key] = conn_id
+    return conn_id
+
+
+parser = argparse.ArgumentParser(description="Run a Deep Research agent in Azure AI Foundry.")
+parser.add_argument("--cleanup", action="store_true", help="Delete the cached agent and thread after this run.")
+parser.add_argument("--new-thread", action="store_true", help="Start a new thread instead of reusing the cached one.")
+args = parser.parse_args()
+cache = load_agent_cache()
+
+
+async def main():
+    async with (  
+        make_credential() as credential,  
+        AIProjectClient(endpoint=project_endpoint, credential=credential) as project_client,  
+    ):  
+        agents_client = project_client.agents  
   
-        agent = agents_client.create_agent(  
-            model=model,  
-            name="my-deep-research-agent",  
-            instructions="You are a helpful Agent that assists in researching scientific topics.",  
-            tools=deep_research_tool.definitions,  
-        )  
-        print(f"Created agent, ID: {agent.id}")  
+        # Reuse the agent from a previous run if it still exists, otherwise create it  
+        agent = None  
+        if cache.get("agent_id"):  
+            try:  
+                agent = await agents_client.get_agent(cache["agent_id"])  
+                print(f"Reusing agent, ID: {agent.id}")  
+            except ResourceNotFoundError:  
+                cache.pop("thread_id", None)  
+        if agent is None:  
+            # Initialize a Deep Research tool (only needed when the agent is created)  
+            deep_research_tool = DeepResearchTool(  
+                bing_grounding_connection_id=await resolve_bing_conn_id(project_client),  
+                deep_research_model=deep_research_model,  
+            )  
+            agent = await agents_client.create_agent(  
+                model=model,  
+                name="my-deep-research-agent",  
+                instructions="You are a helpful Agent that assists in researching scientific topics.",  
+                tools=deep_research_tool.definitions,  
+            )  
+            print(f"Created agent, ID: {agent.id}")  
+            cache["agent_id"] = agent.id  
   
-        # Create thread for communication  
-        thread = agents_client.threads.create()  
-        print(f"Created thread, ID: {thread.id}")  
+        # Reuse the thread for related queries so the shared prefix stays cached  
+        thread = None  
+        if cache.get("thread_id") and not args.new_thread:  
+            try:  
+                thread = await agents_client.threads.get(cache["thread_id"])  
+                print(f"Reusing thread, ID: {thread.id}")  
+            except ResourceNotFoundError:  
+                pass  
+        if thread is None:  
+            thread = await agents_client.threads.create()  
+            print(f"Created thread, ID: {thread.id}")  
+        cache["thread_id"] = thread.id  
+        save_agent_cache(cache)  
   
         # Create a message in the thread  
-        message = agents_client.messages.create(  
+        message = await agents_client.messages.create(  
             thread_id=thread.id,  
             role="user",  
             content=(  
@@ -73,20 +136,29 @@ with AIProjectClient(
   
         # Process Agent run and invoke the event handler on every streamed event.  
         # It may take a few minutes for the agent to complete the run.  
-        with agents_client.runs.stream(  
+        async with await agents_client.runs.stream(  
             thread_id=thread.id, agent_id=agent.id, event_handler=MyEventHandler()  
         ) as stream:  
-            stream.until_done()  
+            await stream.until_done()  
   
-        # Fetch the last message from the agent in the thread  
-        response_message = agents_client.messages.get_last_message_by_role(  
-            thread_id=thread.id, role=MessageRole.AGENT  
-        )  
+        # Fetch only the newest message (one item, newest first) instead of scanning the thread  
+        response_message = None  
+        async for m in agents_client.messages.list(thread_id=thread.id, order=ListSortOrder.DESCENDING, limit=1):  
+            if m.role == MessageRole.AGENT:  
+                response_message = m  
+            break  
         if response_message:  
             for text_message in response_message.text_messages:  
                 print(f"Agent response: {text_message.text.value}")  
                 for annotation in response_message.url_citation_annotations:  
                     print(f"URL Citation: [{annotation.url_citation.title}]({annotation.url_citation.url})")  
   
-        # Delete the Agent when done  
-        agents_client.delete_agent(agent.id)  
\ No newline at end of file
+        # Delete the Agent and thread only when asked to, so the next run can reuse them  
+        if args.cleanup:  
+            await agents_client.threads.delete(thread.id)  
+            await agents_client.delete_agent(agent.id)  
+            os.remove(agent_cache_file)  
+            print("Deleted agent and thread.")
+
+
+asyncio.run(main())
@@ -3,26 +3,39 @@ deepresearch_sk_stream_and_summarize.py
 
 - Streams a Deep Research agent run from Azure AI Foundry (prints CoT deltas).
 - Collects the final agent response.
-- Uses Semantic Kernel + AzureChatCompletion to generate a structured report from the final response.
+- Uses Semantic Kernel + AzureChatCompletion to generate a structured report from the final response,
+  starting as soon as the final answer is streamed instead of after the run has been torn down.
 
 Notes:
 - Requires environment variables (see top of file).
-- Uses Foundry's streaming API (agents.runs.stream) which is robust for long jobs.
+- Uses Foundry's async client and streaming API (agents.runs.stream), so the event loop stays
+  free while the long run streams and the SK report can overlap it.
 - After streaming completes, the final response is post-processed by Semantic Kernel.
+- Prompts semantically close to an earlier one are answered from a local cache
+  (.research_cache.json) without running either model; pass --no-cache for fresh research.
 """
 
+import argparse
+import math
 import os
-import inspect
+import sys
+import asyncio
+import json
+import time
 from dotenv import load_dotenv
 
-# Azure Foundry SDK (sync pattern used below)
-from azure.identity import DefaultAzureCredential
-from azure.ai.projects import AIProjectClient
-from azure.ai.agents.models import DeepResearchTool, AgentEventHandler, MessageRole
+# Azure Foundry SDK (async clients)
+from azure.identity.aio import AzureCliCredential, ManagedIdentityCredential
+from azure.ai.projects.aio import AIProjectClient
+from azure.ai.agents.models import DeepResearchTool, AsyncAgentEventHandler, ListSortOrder, MessageRole
 
 # Semantic Kernel
-from semantic_kernel import Kernel
-from semantic_kernel.connectors.ai.open_ai import AzureChatCompletion
+from semantic_kernel.connectors.ai.open_ai import (
+    AzureChatCompletion,
+    AzureChatPromptExecutionSettings,
+    AzureTextEmbedding,
+)
+from semantic_kernel.contents import ChatHistory
 
 load_dotenv()
 
@@ -39,19 +52,144 @@ PROJECT_ENDPOINT = require_env("AZURE_AI_AGENT_ENDPOINT")
 DEPLOYMENT_MODEL = require_env("AZURE_OPENAI_DEPLOYMENT_NAME")
 DEEP_RESEARCH_MODEL = require_env("AZURE_DEEP_RESEARCH_DEPLOYMENT_NAME")
 BING_CONN_NAME = require_env("AZURE_BING_CONNECTION_NAME")
+BING_CONN_CACHE_FILE = os.environ.get("BING_CONN_CACHE_FILE", ".bing_conn_cache.json")
 
 # Semantic Kernel config
 SK_AZURE_OPENAI_ENDPOINT = require_env("AZURE_OPENAI_ENDPOINT")
 SK_AZURE_OPENAI_KEY = require_env("AZURE_OPENAI_API_KEY")
 SK_AZURE_OPENAI_DEPLOYMENT = require_env("AZURE_OPENAI_DEPLOYMENT_NAME")
+# Generation budget for the structured report (latency grows with generated tokens)
+REPORT_MAX_TOKENS = int(os.getenv("REPORT_MAX_TOKENS", "350"))
+# The report is a formatting task: if the SK deployment is a reasoning model, set this to "low".
+# Leave it unset for non-reasoning deployments (e.g. gpt-4o), which reject the parameter.
+REPORT_REASONING_EFFORT = os.getenv("REPORT_REASONING_EFFORT")
+
+# Semantic cache config (prompt embedding -> final text + report)
+SK_AZURE_OPENAI_EMBEDDING_DEPLOYMENT = os.environ.get("AZURE_OPENAI_EMBEDDING_DEPLOYMENT_NAME", "text-embedding-3-small")
+SEMANTIC_CACHE_FILE = os.environ.get("SEMANTIC_CACHE_FILE", ".research_cache.json")
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.95"))
+
+RESEARCH_PROMPT = (
+    "Research recent breakthroughs in quantum computing and the key researchers involved. "
+    "Provide short citations and a concise 3-bullet summary at the end."
+)
 
 # -------------------------
-# Event handler: prints CoT deltas
+# Credential: managed identity in Azure (AZURE_CLIENT_ID), Azure CLI login locally.
+# An explicit credential avoids DefaultAzureCredential probing every source on cold start;
+# one instance is shared so its token cache is reused.
+# -------------------------
+def make_credential():
+    if os.getenv("AZURE_CLIENT_ID"):
+        return ManagedIdentityCredential(client_id=os.environ["AZURE_CLIENT_ID"])
+    return AzureCliCredential()
+
+CREDENTIAL = make_credential()
+
 # -------------------------
-class CoTEventHandler(AgentEventHandler):
-    """Event handler for Foundry streaming that prints Chain-of-Thought style events."""
+# Semantic Kernel post-processor (built once at module load)
+# -------------------------
+# The report is a single templated prompt, so the chat service is called directly (no Kernel)
+sk_chat = AzureChatCompletion(
+    service_id="foundry-sk-chat",
+    api_key=SK_AZURE_OPENAI_KEY,
+    deployment_name=SK_AZURE_OPENAI_DEPLOYMENT,
+    endpoint=SK_AZURE_OPENAI_ENDPOINT,
+)
+
+# Prompt to turn the raw final_text into a structured report
+REPORT_PROMPT_TEMPLATE = """
+You are an expert technical writer. Given the agent's final research output below, produce:
+1) A short executive summary (3 sentences).
+2) Key findings (3-6 bullets).
+3) Short list of the most-cited sources (if citations are inline, extract them).
+4) A 2-sentence final recommendation.
+Finish the report with a line containing only "=== End ===".
+
+=== Agent output start ===
+{agent_output}
+=== Agent output end ===
+"""
+
+# Short, deterministic completions that stop as soon as the template is filled.
+# Reasoning models reject temperature, stop and max_tokens, so they get a token cap only
+# (max_completion_tokens, which also covers their reasoning tokens).
+if REPORT_REASONING_EFFORT:
+    REPORT_SETTINGS = AzureChatPromptExecutionSettings(
+        service_id="foundry-sk-chat",
+        max_completion_tokens=REPORT_MAX_TOKENS,
+        reasoning_effort=REPORT_REASONING_EFFORT,
+    )
+else:
+    REPORT_SETTINGS = AzureChatPromptExecutionSettings(
+        service_id="foundry-sk-chat",
+        max_tokens=REPORT_MAX_TOKENS,
+        temperature=0.2,
+        stop=["\n=== End ==="],
+    )
+
+async def stream_sk_report(agent_output: str, echo: bool = True) -> str:
+    # Send the templated prompt as the user turn and print the report token by token.
+    # With echo=False the report is only collected, so it can be generated while the
+    # agent run is still printing and shown once the run output is done.
+    history = ChatHistory()
+    history.add_user_message(REPORT_PROMPT_TEMPLATE.format(agent_output=agent_output))
+
+    if echo:
+        print("\n=== Structured Report from Semantic Kernel ===\n")
+    parts = []
+    async for chunk in sk_chat.get_streaming_chat_message_content(history, REPORT_SETTINGS):
+        if chunk is not None and chunk.content:
+            parts.append(chunk.content)
+            if echo:
+                print(chunk.content, end="", flush=True)
+    if echo:
+        print()
+    return "".join(parts) or "<no-result>"
+
+# Streamed deltas are written to stdout in batches rather than one flush per chunk
+DELTA_FLUSH_INTERVAL = 0.05  # seconds
+DELTA_FLUSH_CHUNKS = 32
 
-    def on_message_delta(self, delta):
+# -------------------------
+# Event handler: prints CoT deltas
+# -------------------------
+class CoTEventHandler(AsyncAgentEventHandler):
+    """Event handler for Foundry streaming that prints Chain-of-Thought style events.
+
+    The text of the last streamed message is kept in ``final_text`` and the last
+    completed agent message in ``final_message``, so no fetch is needed after the run.
+    The Semantic Kernel report is started as a task (``report_task``) as soon as the
+    answer that follows the deep research tool call has completed; it is collected
+    without printing so it does not interleave with the rest of the run output.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.final_message = None
+        self.report_task = None
+        self._research_done = False
+        self._message_id = None
+        self._parts = []
+        self._buf = []
+        self._last = time.monotonic()
+
+    @property
+    def final_text(self) -> str:
+        return "".join(self._parts)
+
+    def _flush(self):
+        if self._buf:
+            sys.stdout.write("".join(self._buf))
+            self._buf.clear()
+        sys.stdout.flush()
+        self._last = time.monotonic()
+
+    async def on_message_delta(self, delta):
+        # a new message id means the previous one (e.g. a CoT summary) is finished
+        if getattr(delta, "id", None) != self._message_id:
+            self._message_id = getattr(delta, "id", None)
+            self._parts = []
         # delta.content may carry small text chunks as they stream
         # many SDKs use delta.content.text.value shape
         content = getattr(delta, "content", None)
@@ -66,28 +204,90 @@ class CoTEventHandler(AgentEventHandler):
                     txt = t
             # fallback: print repr
             if txt:
-                print(txt, end="", flush=True)
+                self._parts.append(txt)
+                self._buf.append(txt)
+                if len(self._buf) >= DELTA_FLUSH_CHUNKS or time.monotonic() - self._last > DELTA_FLUSH_INTERVAL:
+                    self._flush()
             else:
+                self._flush()
                 print("[delta]", content)
 
-    def on_run_step(self, step):
-        # Called when a step (tool call / function) starts/updates
-        print(f"\n\n[Tool step -> type: {getattr(step, 'type', '<unknown>')}]")
-        step_details = getattr(step, "step_details", None)
-        if step_details and hasattr(step_details, "tool_calls"):
-            for call in step_details.tool_calls:
+    async def on_run_step(self, step):
+        # Called when a step (tool call / function) starts/updates.
+        # Direct attribute access on the fast path; output goes out in a single flush.
+        try:
+            step_type = step.type
+            calls = step.step_details.tool_calls or ()
+        except AttributeError:
+            step_type = getattr(step, "type", "<unknown>")
+            calls = ()
+        self._buf.append(f"\n\n[Tool step -> type: {step_type}]\n")
+        for call in calls:
+            try:
+                label, status, call_type = call.tool_label, call.status, call.type
+            except AttributeError:
                 label = getattr(call, "tool_label", getattr(call, "tool_name", "<tool>"))
                 status = getattr(call, "status", "<status>")
-                print(f" → {label}: {status}")
-
-    def on_done(self):
+                call_type = getattr(call, "type", None)
+            self._buf.append(f" → {label}: {status}\n")
+            if call_type == "deep_research" and status == "completed":
+                self._research_done = True
+        self._flush()
+
+    async def on_thread_message(self, message):
+        # keep the completed agent message (with its citations) as it streams by
+        if message.role == MessageRole.AGENT and message.status == "completed":
+            self.final_message = message
+            # the answer after the research tool call is final: start the report now
+            if self._research_done and self.report_task is None:
+                final_text = self.final_text or extract_final_text(message)
+                self.report_task = asyncio.create_task(stream_sk_report(final_text, echo=False))
+
+    async def on_done(self):
+        self._flush()
         print("\n\n✅ Agent run complete.\n")
 
+# -------------------------
+# Helper: resolve the Bing connection id once and cache it (env var or local file)
+# -------------------------
+async def resolve_bing_conn_id(project_client, endpoint: str, name: str) -> str:
+    conn_id = os.environ.get("BING_CONN_ID")
+    if conn_id:
+        return conn_id
+    key = f"{endpoint}|{name}"
+    cache = {}
+    if os.path.exists(BING_CONN_CACHE_FILE):
+        with open(BING_CONN_CACHE_FILE) as f:
+            cache = json.load(f)
+    if key not in cache:
+        cache[key] = (await project_client.connections.get(name=name)).id
+        with open(BING_CONN_CACHE_FILE, "w") as f:
+            json.dump(cache, f)
+    return cache[key]
+
+# -------------------------
+# Helper: fetch the newest agent message without scanning the whole thread
+# -------------------------
+async def get_last_agent_message(agents_client, thread_id):
+    async for m in agents_client.messages.list(thread_id=thread_id, order=ListSortOrder.DESCENDING, limit=1):
+        return m if m.role == MessageRole.AGENT else None
+    return None
+
 # -------------------------
 # Helper: extract final text from a response message object
 # -------------------------
 def extract_final_text(response_message) -> str:
-    # Many SDKs expose 'text_messages' where each has .text.value
+    # Fast path: Foundry messages expose 'text_messages' where each has .text.value
+    try:
+        parts = [str(tm.text.value) for tm in (response_message.text_messages or ())]
+    except (AttributeError, TypeError):
+        parts = None
+    if parts:
+        return "\n\n".join(parts)
+    return _extract_final_text_fallback(response_message)
+
+def _extract_final_text_fallback(response_message) -> str:
+    # Other SDK shapes: probe for 'text_messages', then .content, then str()
     text_msgs = getattr(response_message, "text_messages", None)
     if text_msgs:
         parts = []
@@ -107,18 +307,74 @@ def extract_final_text(response_message) -> str:
     return str(response_message)
 
 # -------------------------
-# Main flow
+# Semantic cache: reuse the result of a near-identical earlier prompt
 # -------------------------
-def main():
-    cred = DefaultAzureCredential()
+sk_embedding = AzureTextEmbedding(
+    api_key=SK_AZURE_OPENAI_KEY,
+    deployment_name=SK_AZURE_OPENAI_EMBEDDING_DEPLOYMENT,
+    endpoint=SK_AZURE_OPENAI_ENDPOINT,
+)
+
+async def embed_prompt(prompt: str) -> list:
+    embeddings = await sk_embedding.generate_embeddings([prompt])
+    return [float(x) for x in embeddings[0]]
+
+def cosine_similarity(a: list, b: list) -> float:
+    dot = sum(x * y for x, y in zip(a, b))
+    norm = math.sqrt(sum(x * x for x in a)) * math.sqrt(sum(y * y for y in b))
+    return dot / norm if norm else 0.0
+
+def load_semantic_cache() -> list:
+    if not os.path.exists(SEMANTIC_CACHE_FILE):
+        return []
+    with open(SEMANTIC_CACHE_FILE) as f:
+        return json.load(f)
+
+def semantic_cache_get(embedding: list):
+    # Return the closest cached entry if it is similar enough, else None
+    best, best_score = None, SEMANTIC_CACHE_THRESHOLD
+    for entry in load_semantic_cache():
+        score = cosine_similarity(embedding, entry["embedding"])
+        if score >= best_score:
+            best, best_score = entry, score
+    return best
+
+def semantic_cache_put(prompt: str, embedding: list, final_text: str, report: str):
+    entries = load_semantic_cache()
+    entries.append({"prompt": prompt, "embedding": embedding, "final_text": final_text, "report": report})
+    with open(SEMANTIC_CACHE_FILE, "w") as f:
+        json.dump(entries, f)
 
-    # Use sync Foundry client (the streaming examples use a sync client & context managers)
-    with AIProjectClient(endpoint=PROJECT_ENDPOINT, credential=cred) as project_client:
+# -------------------------
+# Main flow
+# -------------------------
+async def main(use_cache: bool = True):
+    prompt_embedding = None
+    if use_cache:
+        # The cache is optional: without a working embedding deployment, just run the research
+        try:
+            prompt_embedding = await embed_prompt(RESEARCH_PROMPT)
+        except Exception as e:
+            print(f"[warn] Semantic cache disabled, embedding failed: {e}")
+    if prompt_embedding is not None:
+        cached = semantic_cache_get(prompt_embedding)
+        if cached:
+            print(f"[info] Semantic cache hit for prompt: {cached['prompt']!r}")
+            print(f"[info] Cached agent response (len={len(cached['final_text'])} chars)\n")
+            print("\n=== Structured Report from Semantic Kernel ===\n")
+            print(cached["report"])
+            print("\nDone.")
+            return
+
+    # Async Foundry client: the run streams without blocking the loop, so the SK report can overlap it
+    async with (
+        CREDENTIAL,
+        AIProjectClient(endpoint=PROJECT_ENDPOINT, credential=CREDENTIAL) as project_client,
+    ):
 
         # 1) Resolve Bing connection by name -> get id
         print("[info] Resolving Bing connection name -> id...")
-        conn = project_client.connections.get(name=BING_CONN_NAME)
-        bing_conn_id = conn.id
+        bing_conn_id = await resolve_bing_conn_id(project_client, PROJECT_ENDPOINT, BING_CONN_NAME)
         print(f"[info] Resolved Bing connection id: {bing_conn_id}")
 
         # 2) Build DeepResearchTool for the agent
@@ -129,7 +385,7 @@ def main():
 
         # 3) Create agent in Foundry (or reuse an existing agent)
         print("[info] Creating agent definition in Foundry...")
-        agent = project_client.agents.create_agent(
+        agent = await project_client.agents.create_agent(
             model=DEPLOYMENT_MODEL,
             name="DeepResearchAgent-SK-Streaming",
             instructions="You are a careful research assistant. Think step-by-step and show intermediate tool calls/results.",
@@ -139,31 +395,31 @@ def main():
         print(f"[info] Agent id: {getattr(agent, 'id', '<no-id>')}")
 
         # 4) Create a thread and a message (user prompt)
-        thread = project_client.agents.threads.create()
+        thread = await project_client.agents.threads.create()
         print(f"[info] Created thread id: {thread.id}")
 
-        message = project_client.agents.messages.create(
+        message = await project_client.agents.messages.create(
             thread_id=thread.id,
             role="user",
-            content=(
-                "Research recent breakthroughs in quantum computing and the key researchers involved. "
-                "Provide short citations and a concise 3-bullet summary at the end."
-            ),
+            content=RESEARCH_PROMPT,
         )
         print(f"[info] Created message id: {message.id}")
 
-        # 5) Stream the agent run with CoT event handler (blocks until done)
+        # 5) Stream the agent run with CoT event handler
         print("[info] Starting streaming run (this may take a little while)...\n")
         handler = CoTEventHandler()
-        # the streaming context manager will call handler.on_message_delta, on_run_step, on_done as events arrive
-        with project_client.agents.runs.stream(thread_id=thread.id, agent_id=agent.id, event_handler=handler) as stream:
-            stream.until_done()  # waits until the run completes and streams events
-
-        # 6) Fetch the final agent message and extract text
-        response_message = project_client.agents.messages.get_last_message_by_role(thread_id=thread.id, role=MessageRole.AGENT)
+        # iterating the stream calls handler.on_message_delta, on_run_step, on_done as events arrive
+        async with await project_client.agents.runs.stream(
+            thread_id=thread.id, agent_id=agent.id, event_handler=handler
+        ) as stream:
+            async for _ in stream:
+                pass
+
+        # 6) Use the final agent message captured by the handler (fetch it only as a fallback)
+        response_message = handler.final_message or await get_last_agent_message(project_client.agents, thread.id)
         if not response_message:
             raise RuntimeError("Agent did not produce a final message in the thread.")
-        final_text = extract_final_text(response_message)
+        final_text = handler.final_text or extract_final_text(response_message)
         print("\n\n[info] Final agent response captured (len=%d chars)\n" % len(final_text))
 
         # Optional: show URL citations if available
@@ -172,52 +428,26 @@ def main():
             if uc:
                 print(f"[citation] {getattr(uc, 'title', '<title>')} -> {getattr(uc, 'url', '<url>')}")
 
+        report_task = handler.report_task
+
     # -------------------------
-    # 7) Post-process with Semantic Kernel (structured report)
+    # 7) Structured report from Semantic Kernel (started while the run was finishing)
     # -------------------------
-    print("\n[info] Now invoking Semantic Kernel to create a structured report from the final agent output...\n")
-
-    # Create Kernel and add Azure OpenAI chat completion service (AzureChatCompletion)
-    kernel = Kernel()
-    # Create an AzureChatCompletion instance and add to kernel
-    sk_chat = AzureChatCompletion(
-        service_id="foundry-sk-chat",
-        api_key=SK_AZURE_OPENAI_KEY,
-        deployment_name=SK_AZURE_OPENAI_DEPLOYMENT,
-        endpoint=SK_AZURE_OPENAI_ENDPOINT,
-    )
-    kernel.add_service(sk_chat)
-
-    # Prepare a Semantic Kernel prompt to turn the raw final_text into a structured report
-    prompt_template = """
-You are an expert technical writer. Given the agent's final research output below, produce:
-1) A short executive summary (3 sentences).
-2) Key findings (3-6 bullets).
-3) Short list of the most-cited sources (if citations are inline, extract them).
-4) A 2-sentence final recommendation.
-
-=== Agent output start ===
-{agent_output}
-=== Agent output end ===
-"""
-    # Create a simple semantic function on the kernel
-    from semantic_kernel.semantic_functions import SemanticFunctionConfig
-    from semantic_kernel.orchestration import Plan
-
-    # Some SK versions provide create_semantic_function; use the generic add_service + run text completion if needed.
-    # For compatibility, we'll use the chat completion service directly via kernel.run
-    # Build input and call the chat service through kernel
-    prompt = prompt_template.format(agent_output=final_text)
-
-    # Call the chat completion service (non-streaming) to create the structured report
-    # The exact API to invoke SK's chat completion may vary by SK version; the following is compatible with current SK patterns:
-    result = kernel.run(prompt, max_tokens=800)  # kernel.run uses registered chat completion service
-
-    report_text = str(result) if result is not None else "<no-result>"
-    print("\n=== Structured Report from Semantic Kernel ===\n")
-    print(report_text)
+    if report_task is not None:
+        # generated silently during the run; print it now that the run output is done
+        report_text = await report_task
+        print("\n=== Structured Report from Semantic Kernel ===\n")
+        print(report_text)
+    else:
+        # the handler did not get to it during the stream, so stream it live now
+        report_text = await stream_sk_report(final_text)
+    if prompt_embedding is not None:
+        semantic_cache_put(RESEARCH_PROMPT, prompt_embedding, final_text, report_text)
 
     print("\nDone.")
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description="Deep Research run with a Semantic Kernel structured report.")
+    parser.add_argument("--no-cache", action="store_true", help="Skip the semantic cache and run fresh research.")
+    args = parser.parse_args()
+    asyncio.run(main(use_cache=not args.no_cache))
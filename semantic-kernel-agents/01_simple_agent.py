@@ -20,7 +20,9 @@ async def main():
         instructions="You are a helpful assistant."  
     )  
   
-    response = await agent.get_response(messages="Write a haiku about Semantic Kernel.")  
-    print(response.content)  
+    # Stream the reply so tokens are printed as soon as they arrive  
+    async for chunk in agent.invoke_stream(messages="Write a haiku about Semantic Kernel."):  
+        print(chunk.content, end="", flush=True)  
+    print()  
   
 asyncio.run(main())  
\ No newline at end of file
@@ -54,7 +54,14 @@ async def main():
         arguments=KernelArguments(settings)  
     )  
       
-    response = await agent.get_response(messages="What is the price of the soup special?")  
-    print(response.content)  
+    # Stream the JSON as it is generated, then parse it once the reply is complete  
+    chunks = []  
+    async for chunk in agent.invoke_stream(messages="What is the price of the soup special?"):  
+        print(chunk.content, end="", flush=True)  
+        chunks.append(str(chunk.content))  
+    print()  
+  
+    menu_item = MenuItem.model_validate_json("".join(chunks))  
+    print(f"{menu_item.name}: ${menu_item.price:.2f}")  
   
 asyncio.run(main())  
\ No newline at end of file
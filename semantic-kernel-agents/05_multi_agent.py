@@ -1,11 +1,21 @@
 import os  
+import sys  
 import asyncio  
+import importlib.util  
+import threading  
+from typing import Annotated  
+import httpx  
+import orjson  
 from dotenv import load_dotenv  
+from openai import AsyncAzureOpenAI  
   
 from semantic_kernel import Kernel  
 from semantic_kernel.agents import ChatCompletionAgent, ChatHistoryAgentThread  
+from semantic_kernel.connectors.ai.open_ai import OpenAIChatPromptExecutionSettings  
 from semantic_kernel.connectors.ai.open_ai.services.azure_chat_completion import AzureChatCompletion  
+from semantic_kernel.contents import ChatHistory  
 from semantic_kernel.filters import FunctionInvocationContext  
+from semantic_kernel.functions import kernel_function  
   
 # 1. Load environment variables from .env  
 load_dotenv()  
@@ -26,72 +36,160 @@ AZURE_ENDPOINT = os.environ["AZURE_OPENAI_ENDPOINT"]
 AZURE_DEPLOYMENT = os.environ["AZURE_OPENAI_DEPLOYMENT_NAME"]  
 AZURE_API_VERSION = os.environ.get("AZURE_OPENAI_API_VERSION", "2023-05-15")  
   
-# 3. Create the AzureChatCompletion service  
-azure_service = AzureChatCompletion(  
-    endpoint=AZURE_ENDPOINT,  
-    api_key=AZURE_KEY,  
-    deployment_name=AZURE_DEPLOYMENT,  
-    api_version=AZURE_API_VERSION  
-)  
+# One keep-alive connection pool for every agent; HTTP/2 multiplexes their concurrent  
+# requests over a single connection when the optional `h2` package is installed.  
+HTTP_LIMITS = httpx.Limits(max_keepalive_connections=32)  
+HTTP2_ENABLED = importlib.util.find_spec("h2") is not None  
   
 # 4. Kernel and filter definition  
 kernel = Kernel()  
   
 async def function_invocation_filter(context: FunctionInvocationContext, next):  
-    if "messages" not in context.arguments:  
-        await next(context)  
-        return  
-    print(f"    Agent [{context.function.name}] called with messages: {context.arguments['messages']}")  
+    # Log straight to the byte stream with orjson instead of repr()-ing the payloads  
+    name = context.function.name.encode()  
+    out = sys.stdout.buffer  
+    sys.stdout.flush()  
+    out.write(b"    Triage [" + name + b"] called with: " + orjson.dumps(dict(context.arguments), default=str) + b"\n")  
+    out.flush()  
     await next(context)  
-    print(f"    Response from agent [{context.function.name}]: {context.result.value}")  
+    out.write(b"    Triage [" + name + b"] routed to: " + str(context.result.value).encode() + b"\n")  
+    out.flush()  
   
 kernel.add_filter("function_invocation", function_invocation_filter)  
   
-# 5. Define the billing agents  
-billing_agent = ChatCompletionAgent(  
-    service=azure_service,  
-    name="BillingAgent",  
-    instructions=(  
-        "You specialize in handling customer questions related to billing issues. "  
-        "This includes clarifying invoice charges, payment methods, billing cycles, "  
-        "explaining fees, addressing discrepancies in billed amounts, updating payment details, "  
-        "assisting with subscription changes, and resolving payment failures. "  
-        "Your goal is to clearly communicate and resolve issues specifically about payments and charges."  
-    ),  
-)  
-  # Define the refund agent
-refund_agent = ChatCompletionAgent(  
-    service=azure_service,  
-    name="RefundAgent",  
-    instructions=(  
-        "You specialize in addressing customer inquiries regarding refunds. "  
-        "This includes evaluating eligibility for refunds, explaining refund policies, "  
-        "processing refund requests, providing status updates on refunds, handling complaints related to refunds, "  
-        "and guiding customers through the refund claim process. "  
-        "Your goal is to assist users clearly and empathetically to successfully resolve their refund-related concerns."  
-    ),  
-)  
-  # define the triage agent
-triage_agent = ChatCompletionAgent(  
-    service=azure_service,  
-    kernel=kernel,  
-    name="TriageAgent",  
-    instructions=(  
-        "Your role is to evaluate the user's request and forward it to the appropriate agent based on the nature of "  
-        "the query. Forward requests about charges, billing cycles, payment methods, fees, or payment issues to the "  
-        "BillingAgent. Forward requests concerning refunds, refund eligibility, refund policies, or the status of "  
-        "refunds to the RefundAgent. Your goal is accurate identification of the appropriate specialist to ensure the "  
-        "user receives targeted assistance."  
-    ),  
-    plugins=[billing_agent, refund_agent],  
-)  
-  
-thread: ChatHistoryAgentThread = None  
+# Router plugin: the triage agent only decides *where* a request goes; the  
+# specialists are then called directly so independent sub-queries overlap.  
+class TriageRouterPlugin:  
+    @kernel_function(description="Route the user's request to the specialist agents that should handle it.")  
+    def route(  
+        self,  
+        billing_query: Annotated[str, "The part of the request for the BillingAgent, or empty if none."] = "",  
+        refund_query: Annotated[str, "The part of the request for the RefundAgent, or empty if none."] = "",  
+    ) -> Annotated[str, "A JSON list of [agent_name, sub_query] pairs."]:  
+        routes = [  
+            ["BillingAgent", billing_query],  
+            ["RefundAgent", refund_query],  
+        ]  
+        return orjson.dumps([[name, query] for name, query in routes if query.strip()]).decode()  
+  
+# 5. Define the billing, refund and triage agents on a shared service  
+agents: dict[str, ChatCompletionAgent] = {}  
+threads: dict[str, ChatHistoryAgentThread] = {}  
+  
+def create_agents(service: AzureChatCompletion) -> ChatCompletionAgent:  
+    billing_agent = ChatCompletionAgent(  
+        service=service,  
+        name="BillingAgent",  
+        instructions=(  
+            "You specialize in handling customer questions related to billing issues. "  
+            "This includes clarifying invoice charges, payment methods, billing cycles, "  
+            "explaining fees, addressing discrepancies in billed amounts, updating payment details, "  
+            "assisting with subscription changes, and resolving payment failures. "  
+            "Your goal is to clearly communicate and resolve issues specifically about payments and charges."  
+        ),  
+    )  
+    # Define the refund agent
+    refund_agent = ChatCompletionAgent(  
+        service=service,  
+        name="RefundAgent",  
+        instructions=(  
+            "You specialize in addressing customer inquiries regarding refunds. "  
+            "This includes evaluating eligibility for refunds, explaining refund policies, "  
+            "processing refund requests, providing status updates on refunds, handling complaints related to refunds, "  
+            "and guiding customers through the refund claim process. "  
+            "Your goal is to assist users clearly and empathetically to successfully resolve their refund-related concerns."  
+        ),  
+    )  
+  
+    agents.update({agent.name: agent for agent in (billing_agent, refund_agent)})  
+  
+    # define the triage agent
+    return ChatCompletionAgent(  
+        service=service,  
+        kernel=kernel,  
+        name="TriageAgent",  
+        instructions=(  
+            "Your role is to evaluate the user's request and route it to the appropriate agents based on the nature of "  
+            "the query. Send the parts about charges, billing cycles, payment methods, fees, or payment issues to the "  
+            "BillingAgent. Send the parts concerning refunds, refund eligibility, refund policies, or the status of "  
+            "refunds to the RefundAgent. A request may touch both. Always call the route function exactly once and "  
+            "reply with its JSON result verbatim, without any other text."  
+        ),  
+        plugins=[TriageRouterPlugin()],  
+    )  
+  
+def parse_routes(triage_output: str) -> list[tuple[str, str]]:  
+    """Parse the triage agent's JSON output into (agent_name, sub_query) pairs."""  
+    try:  
+        routes = orjson.loads(triage_output)  
+    except orjson.JSONDecodeError:  
+        return []  
+    if not isinstance(routes, list):  
+        return []  
+    # Any other shape (plain text, objects, rows that aren't string pairs) means no routes  
+    return [  
+        (route[0], route[1])  
+        for route in routes  
+        if isinstance(route, list)  
+        and len(route) == 2  
+        and all(isinstance(part, str) for part in route)  
+        and route[0] in agents  
+        and route[1]  
+    ]  
+  
+async def ask_agent(name: str, query: str) -> str:  
+    """Send a sub-query to a specialist agent, keeping one thread per agent."""  
+    print(f"    Agent [{name}] called with messages: {query}")  
+    response = await agents[name].get_response(messages=query, thread=threads.get(name))  
+    threads[name] = response.thread  
+    print(f"    Response from agent [{name}]: {response}")  
+    return f"{name}: {response}"  
+  
+_stdin_lines: asyncio.Queue | None = None  
+  
+def read_stdin_lines(loop: asyncio.AbstractEventLoop, lines: asyncio.Queue) -> None:  
+    """Feed stdin into `lines` one line at a time, then None at end of input.  
+  
+    Reads straight from the file descriptor rather than through sys.stdin, so a daemon  
+    thread blocked here never holds sys.stdin's lock while the interpreter exits.  
+    """  
+    encoding = sys.stdin.encoding or "utf-8"  
+    pending = b""  
+    while True:  
+        chunk = os.read(sys.stdin.fileno(), 65536)  
+        pending += chunk  
+        *complete, pending = pending.split(b"\n")  
+        if not chunk and pending:  
+            complete.append(pending)  # last line had no trailing newline  
+        try:  
+            for line in complete:  
+                loop.call_soon_threadsafe(lines.put_nowait, line.decode(encoding).rstrip("\r"))  
+            if not chunk:  
+                loop.call_soon_threadsafe(lines.put_nowait, None)  
+                return  
+        except RuntimeError:  
+            return  # the loop already closed  
+  
+async def read_input(prompt: str) -> str:  
+    """Read one line off the event loop so background warm-up keeps running."""  
+    global _stdin_lines  
+    if _stdin_lines is None:  
+        _stdin_lines = asyncio.Queue()  
+        threading.Thread(  
+            target=read_stdin_lines, args=(asyncio.get_running_loop(), _stdin_lines), daemon=True  
+        ).start()  
+  
+    print(prompt, end="", flush=True)  
+    line = await _stdin_lines.get()  
+    if line is None:  
+        _stdin_lines.put_nowait(None)  # stay at end of input for later calls  
+        raise EOFError  
+    return line  
   
 # 6. User interaction/chat routine  
-async def chat() -> bool:  
+async def chat(triage_agent: ChatCompletionAgent) -> bool:  
     try:  
-        user_input = input("User:> ")  
+        user_input = await read_input("User:> ")  
     except (KeyboardInterrupt, EOFError):  
         print("\n\nExiting chat...")  
         return False  
@@ -100,17 +198,22 @@ async def chat() -> bool:
         print("\n\nExiting chat...")  
         return False  
   
-    response = await triage_agent.get_response(  
-        messages=user_input,  
-        thread=thread,  
-    )  
-    if response:  
-        print(f"Agent :> {response}")  
+    triage = await triage_agent.get_response(messages=user_input)  
+    routes = parse_routes(str(triage))  
+    if not routes:  
+        print(f"Agent :> {triage}")  
+        return True  
+  
+    # Sub-agents are independent, so their LLM round-trips run concurrently.  
+    responses = await asyncio.gather(*[ask_agent(name, query) for name, query in routes])  
+    print("Agent :> " + "\n\n".join(responses))  
     return True  
 """
 Sample Output:
 
 User:> I was charged twice for my subscription last month, can I get one of those payments refunded?
+    Triage [route] called with: {"billing_query":"I was charged twice for my subscription last month.","refund_query":"Can I get one of those payments refunded?"}
+    Triage [route] routed to: [["BillingAgent","I was charged twice for my subscription last month."],["RefundAgent","Can I get one of those payments refunded?"]]
     Agent [BillingAgent] called with messages: I was charged twice for my subscription last month.
     Agent [RefundAgent] called with messages: Can I get one of those payments refunded?
     Response from agent RefundAgent: Of course, I'll be happy to help you with your refund inquiry. Could you please 
@@ -142,13 +245,46 @@ Once we have these details, we can proceed with resolving the duplicate charge a
 have any more questions, feel free to ask!
 """
   
+async def warm_up(service: AzureChatCompletion) -> None:  
+    """Send a 1-token ping so the connection and deployment are warm while the user is still typing."""  
+    history = ChatHistory()  
+    history.add_user_message("ping")  
+    try:  
+        await service.get_chat_message_content(history, OpenAIChatPromptExecutionSettings(max_tokens=1))  
+    except Exception as e:  
+        print(f"    (warm-up skipped: {e})")  
+  
 async def main() -> None:  
+    async with httpx.AsyncClient(limits=HTTP_LIMITS, http2=HTTP2_ENABLED) as http_client:  
+        # 3. Create the AzureChatCompletion service on the shared HTTP client, used by all three agents  
+        azure_service = AzureChatCompletion(  
+            deployment_name=AZURE_DEPLOYMENT,  
+            async_client=AsyncAzureOpenAI(  
+                azure_endpoint=AZURE_ENDPOINT,  
+                api_key=AZURE_KEY,  
+                api_version=AZURE_API_VERSION,  
+                http_client=http_client,  
+            ),  
+        )  
+        await run_chat(azure_service)  
+  
+async def run_chat(azure_service: AzureChatCompletion) -> None:  
+    triage_agent = create_agents(azure_service)  
+  
     print("Welcome to the chat bot!\n  Type 'exit' to exit.\n  Try to get some billing or refund help.")  
-    chatting = True  
-    while chatting:  
-        chatting = await chat()  
+    warm_up_task = asyncio.create_task(warm_up(azure_service))  
+    try:  
+        chatting = True  
+        while chatting:  
+            chatting = await chat(triage_agent)  
+    finally:  
+        warm_up_task.cancel()  
   
 if __name__ == "__main__":  
-    asyncio.run(main())  
+    try:  
+        asyncio.run(main())  
+    except KeyboardInterrupt:  
+        # Ctrl-C while waiting at the prompt cancels main() and surfaces here  
+        print("\n\nExiting chat...")  
 
     
\ No newline at end of file
@@ -2,16 +2,18 @@
 
 import asyncio
 import os
+from contextlib import AsyncExitStack
 from typing import Annotated
 
 from azure.ai.projects.models import FileSearchTool, OpenAIFile, VectorStore, BingGroundingTool
-from azure.identity.aio import DefaultAzureCredential
+from azure.identity.aio import AzureCliCredential, ManagedIdentityCredential
 
 from semantic_kernel.agents import AzureAIAgent, AzureAIAgentSettings, AzureAIAgentThread
 from semantic_kernel.contents import AuthorRole
 from semantic_kernel.contents import AuthorRole
 from semantic_kernel.agents import ChatCompletionAgent, ChatHistoryAgentThread
-from semantic_kernel.connectors.ai.open_ai import AzureChatCompletion
+from semantic_kernel.connectors.ai.open_ai import AzureChatCompletion, OpenAIChatPromptExecutionSettings
+from semantic_kernel.contents import ChatHistory
 from semantic_kernel.functions import kernel_function
 
 """
@@ -21,74 +23,110 @@ uses a file search tool to answer user questions.
 
 # Simulate a conversation with the agent
 USER_INPUTS = [
+    "Which team won the 2025 NCAA March Madness?",
     "What's the latest on the semantic kernel blog?",
 ]
 
-class SearchAgentPlugin:
+# Kept byte-identical across turns so Azure's prompt cache can reuse the prefix
+HOST_INSTRUCTIONS = "You are a helpful assistant. Reply like a pirate"
 
-    @kernel_function(description="Search for a topic")
-    async def search(self, search_query: Annotated[str, "Search query"]) -> Annotated[str, "search results"]:
-        ai_agent_settings = AzureAIAgentSettings.create()
+SEARCH_AGENT_ID = "asst_I7zm5GEQHBunb1TWMlAdnI3z"
 
-        async with (
-            DefaultAzureCredential() as creds,
-            AzureAIAgent.create_client(credential=creds) as client,
-        ):
+# The credential, client and search agent are created once per process and
+# shared by every search, instead of a new credential handshake per tool call.
+_search_resources = AsyncExitStack()
+_search_agent: AzureAIAgent = None
+_search_agent_lock = asyncio.Lock()
 
-            agent_definition = await client.agents.create_agent(
-                model=ai_agent_settings.model_deployment_name,
-            )
 
-            agent_definition = await client.agents.get_agent("asst_I7zm5GEQHBunb1TWMlAdnI3z")
+def make_credential():
+    # Managed identity in Azure (AZURE_CLIENT_ID), Azure CLI login locally
+    if os.getenv("AZURE_CLIENT_ID"):
+        return ManagedIdentityCredential(client_id=os.environ["AZURE_CLIENT_ID"])
+    return AzureCliCredential()
 
-            agent = AzureAIAgent(
+
+async def get_search_agent() -> AzureAIAgent:
+    global _search_agent
+    async with _search_agent_lock:
+        if _search_agent is None:
+            creds = await _search_resources.enter_async_context(make_credential())
+            client = await _search_resources.enter_async_context(AzureAIAgent.create_client(credential=creds))
+            agent_definition = await client.agents.get_agent(SEARCH_AGENT_ID)
+            _search_agent = AzureAIAgent(
                 client=client,
                 definition=agent_definition,
             )
-            thread: AzureAIAgentThread = None
+    return _search_agent
+
+
+class SearchAgentPlugin:
+
+    def __init__(self):
+        self.thread: AzureAIAgentThread = None
 
-            try:
-                print(f"# Search Query: '{search_query}'")
-                async for response in agent.invoke(messages=search_query, thread=thread):
-                    if response.role != AuthorRole.TOOL:
-                        print(f"# Search Result: {response.content}")
-                        return response.content
-                    thread = response.thread
-            finally:
-                # 7. Cleanup: Delete the thread and agent and other resources
-                await thread.delete() if thread else None
+    @kernel_function(description="Search for a topic")
+    async def search(self, search_query: Annotated[str, "Search query"]) -> Annotated[str, "search results"]:
+        agent = await get_search_agent()
+        if self.thread is None:
+            # One thread for every search, so the agent's prefix stays cached between queries
+            self.thread = AzureAIAgentThread(client=agent.client)
+            _search_resources.push_async_callback(self.delete_thread)
+
+        print(f"# Search Query: '{search_query}'")
+        async for response in agent.invoke(messages=search_query, thread=self.thread):
+            if response.role != AuthorRole.TOOL:
+                print(f"# Search Result: {response.content}")
+                return response.content
+
+    async def delete_thread(self) -> None:
+        # 7. Cleanup: Delete the thread once the shared search resources are closed
+        if self.thread is not None and self.thread.id is not None:
+            await self.thread.delete()
+        self.thread = None
+
+
+async def warm_up(service: AzureChatCompletion) -> None:
+    # 1-token ping so the deployment is warm when the host agent makes its first call
+    history = ChatHistory()
+    history.add_user_message("ping")
+    try:
+        await service.get_chat_message_content(history, OpenAIChatPromptExecutionSettings(max_tokens=1))
+    except Exception as e:
+        print(f"    (warm-up skipped: {e})")
 
 
 async def main() -> None:
 
     ai_agent_settings = AzureAIAgentSettings.create()
 
-    async with (
-        DefaultAzureCredential() as creds,
-        AzureAIAgent.create_client(credential=creds) as client,
-    ):
+    service = AzureChatCompletion()
+    # warm the host deployment while the Foundry client and search agent are being set up
+    warm_up_task = asyncio.create_task(warm_up(service))
 
-        agent_definition = await client.agents.get_agent("asst_I7zm5GEQHBunb1TWMlAdnI3z")
+    async with _search_resources:
 
-        search_agent = AzureAIAgent(
-            client=client,
-            definition=agent_definition,
-        )
+        search_agent = await get_search_agent()
 
         agent = ChatCompletionAgent(
-            service=AzureChatCompletion(),
+            service=service,
             name="Host",
-            instructions="You are a helpful assistant. Reply like a pirate",
+            instructions=HOST_INSTRUCTIONS,
             plugins=[search_agent],
         )
 
+        # One thread for the whole batch of questions
         thread: ChatHistoryAgentThread = None
 
-        user_input = "Which team won the 2025 NCAA March Madness?"
-        print(f"# User: {user_input}")
-        
-        response = await agent.get_response(messages=user_input, thread=thread)
-        print(f"# {response.name}: {response} ")
+        for user_input in USER_INPUTS:
+            print(f"# User: {user_input}")
+
+            response = await agent.get_response(messages=user_input, thread=thread)
+            print(f"# {response.name}: {response} ")
+            thread = response.thread
+
+    # the ping is long done by now; awaiting it keeps no task pending when the loop closes
+    await warm_up_task
 
 if __name__ == "__main__":
     asyncio.run(main())
\ No newline at end of file
@@ -1,59 +1,792 @@
 # Copyright (c) Microsoft. All rights reserved.
 
+import argparse
 import asyncio
+import collections
+import hashlib
+import heapq
+import html as html_lib
+import json
 import logging
+import logging.handlers
+import math
+import os
+import queue
+import re
+import sqlite3
+import time
+from contextlib import closing
+from typing import Annotated, ClassVar
 
+import httpx
 from autogen_core import SingleThreadedAgentRuntime
+from openai import AsyncOpenAI, NotFoundError
+from openai.types.beta.assistant import Assistant
+
+try:
+    import uvloop
+except ImportError:  # optional, and not available on Windows
+    uvloop = None
 
 from semantic_kernel.agents.chat_completion.chat_completion_agent import ChatCompletionAgent
-from semantic_kernel.agents.open_ai.open_ai_assistant_agent import OpenAIAssistantAgent
+from semantic_kernel.agents.agent import AgentResponseItem, AgentThread
+from semantic_kernel.agents.open_ai.open_ai_assistant_agent import AssistantAgentThread, OpenAIAssistantAgent
 from semantic_kernel.agents.orchestration.magentic_one import MagenticOneOrchestration
+from semantic_kernel.connectors.ai.open_ai import OpenAITextEmbedding
 from semantic_kernel.connectors.ai.open_ai.services.open_ai_chat_completion import OpenAIChatCompletion
+from semantic_kernel.contents import AuthorRole, ChatHistory, ChatMessageContent, StreamingChatMessageContent
+from semantic_kernel.exceptions.agent_exceptions import AgentInvokeException
+from semantic_kernel.functions import kernel_function
 
-logging.basicConfig(level=logging.WARNING)  # Set default level to WARNING
-logging.getLogger("semantic_kernel.agents.orchestration.magentic_one").setLevel(
-    logging.DEBUG
-)  # Enable DEBUG for group chat pattern
+# Agent names, descriptions and instructions are module constants so the system prompt
+# prefix sent on every manager/agent turn is byte-identical across turns and runs, which
+# is what OpenAI's automatic prompt (prefix) caching keys on.
+RESEARCH_AGENT_NAME = "ResearchAgent"
+RESEARCH_AGENT_DESCRIPTION = "A helpful assistant with access to web search. Ask it to perform web searches."
+RESEARCH_AGENT_INSTRUCTIONS = "You are a Researcher. You find information."
+RESEARCH_MODEL_ID = "gpt-4o-search-preview"
+# "retrieval" answers from a precomputed embedding index over a reference article with a
+# small model; "search" uses the live web-search model.
+RESEARCH_MODE = os.getenv("RESEARCH_MODE", "retrieval")
+RETRIEVAL_AGENT_DESCRIPTION = "A helpful assistant with access to a reference corpus. Ask it to look up facts."
+RETRIEVAL_AGENT_INSTRUCTIONS = (
+    "You are a Researcher. You find information by searching the reference corpus and answer"
+    " only from the passages it returns."
+)
+RETRIEVAL_MODEL_ID = "gpt-4o-mini"
 
+CODER_AGENT_NAME = "CoderAgent"
+CODER_AGENT_DESCRIPTION = "A helpful assistant with code interpreter capability."
+CODER_AGENT_INSTRUCTIONS = "You solve questions using code."
+CODE_INTERPRETER_TOOL, CODE_INTERPRETER_RESOURCES = OpenAIAssistantAgent.configure_code_interpreter_tool()
+
+TASK = (
+    "What are the 50 tallest buildings in the world? Create a table with their names"
+    " and heights grouped by country with a column of the average height of the buildings"
+    " in each country"
+)
+
+# Pinned explicitly so the manager prompt always targets the same model (and prefix cache).
+# Manager turns are short planning/routing decisions, so a smaller tier is enough there;
+# the agents keep the larger models.
+MANAGER_MODEL_ID = os.getenv("MANAGER_MODEL_ID", "gpt-4o-mini")
+
+# One HTTP connection pool shared by every OpenAI call (manager, research, coder,
+# embeddings), sized so concurrent agent traffic is not throttled by the default pool.
+HTTP_LIMITS = httpx.Limits(max_connections=512, max_keepalive_connections=256)
+HTTP_TIMEOUT = httpx.Timeout(120.0)
+_openai_client: tuple[AsyncOpenAI, str] | None = None
+
+
+def get_openai_client() -> tuple[AsyncOpenAI, str]:
+    """Return the shared AsyncOpenAI client and the configured chat model, creating them on first use."""
+    global _openai_client
+    if _openai_client is None:
+        _openai_client = OpenAIAssistantAgent.setup_resources(
+            http_client=httpx.AsyncClient(limits=HTTP_LIMITS, timeout=HTTP_TIMEOUT)
+        )
+    return _openai_client
+
+
+async def close_openai_client() -> None:
+    global _openai_client
+    if _openai_client is not None:
+        await _openai_client[0].close()
+        _openai_client = None
+
+
+# Each orchestration registers its agents and subscriptions on the runtime it runs on
+# and nothing unregisters them, so a runtime is retired after this many runs.
+RUNTIME_MAX_USES = int(os.getenv("RUNTIME_MAX_USES", "8"))
+
+
+class RuntimePool:
+    """FIFO pool of started agent runtimes, reused across orchestrations.
+
+    Acquiring an idle runtime skips creating and bootstrapping a new one per task.
+    A runtime is stopped once it has served `max_uses` orchestrations, so the agent
+    registrations and subscriptions left behind by each run stay bounded.
+    """
+
+    def __init__(self, max_uses: int = RUNTIME_MAX_USES) -> None:
+        self.max_uses = max_uses
+        self._idle: collections.deque[SingleThreadedAgentRuntime] = collections.deque()
+        self._uses: dict[SingleThreadedAgentRuntime, int] = {}
+
+    def acquire(self) -> SingleThreadedAgentRuntime:
+        if self._idle:
+            runtime = self._idle.popleft()
+        else:
+            runtime = SingleThreadedAgentRuntime()
+            runtime.start()
+        self._uses[runtime] = self._uses.get(runtime, 0) + 1
+        return runtime
+
+    async def release(self, runtime: SingleThreadedAgentRuntime) -> None:
+        if self._uses[runtime] < self.max_uses:
+            self._idle.append(runtime)
+        else:
+            await self.discard(runtime)
+
+    async def discard(self, runtime: SingleThreadedAgentRuntime) -> None:
+        self._uses.pop(runtime, None)
+        await runtime.stop()
+
+    async def close(self) -> None:
+        while self._idle:
+            await self.discard(self._idle.popleft())
+
+
+runtime_pool = RuntimePool()
+
+
+# Client-side rate limiting so concurrent orchestrations stay inside the account's
+# per-model request/token limits instead of bursting into 429s and retry backoff.
+OPENAI_RPM = int(os.getenv("OPENAI_RPM", "500"))
+OPENAI_TPM = int(os.getenv("OPENAI_TPM", "200000"))
+
+
+class RateLimiter:
+    """Request and token buckets refilled continuously up to per-minute limits.
+
+    Callers wait in FIFO order until both buckets can cover their request.
+    """
+
+    def __init__(self, rpm: int, tpm: int) -> None:
+        self.rpm = rpm
+        self.tpm = tpm
+        self._requests = float(rpm)
+        self._tokens = float(tpm)
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self, tokens: int) -> None:
+        tokens = min(tokens, self.tpm)
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                elapsed, self._updated = now - self._updated, now
+                self._requests = min(self.rpm, self._requests + elapsed * self.rpm / 60)
+                self._tokens = min(self.tpm, self._tokens + elapsed * self.tpm / 60)
+                if self._requests >= 1 and self._tokens >= tokens:
+                    self._requests -= 1
+                    self._tokens -= tokens
+                    return
+                await asyncio.sleep(
+                    max((1 - self._requests) * 60 / self.rpm, (tokens - self._tokens) * 60 / self.tpm)
+                )
+
+
+_rate_limiters: dict[str, RateLimiter] = {}
+
+
+def get_rate_limiter(model: str) -> RateLimiter:
+    """OpenAI limits are per model, so each model gets its own limiter."""
+    if model not in _rate_limiters:
+        _rate_limiters[model] = RateLimiter(OPENAI_RPM, OPENAI_TPM)
+    return _rate_limiters[model]
+
+
+def estimate_tokens(messages: list[str | ChatMessageContent]) -> int:
+    # Roughly four characters per token for English text.
+    return sum(len(str(m.content if isinstance(m, ChatMessageContent) else m)) for m in messages) // 4 + 1
+
+
+# Semantic cache: a task close enough to an earlier one reuses its final answer
+# instead of re-running the whole manager -> agents loop.
+EMBEDDING_MODEL_ID = os.environ.get("OPENAI_EMBEDDING_MODEL_ID", "text-embedding-3-small")
+MAGENTIC_CACHE_FILE = os.environ.get("MAGENTIC_CACHE_FILE", ".magentic_cache.json")
+MAGENTIC_CACHE_THRESHOLD = float(os.getenv("MAGENTIC_CACHE_THRESHOLD", "0.95"))
+
+
+def cosine_similarity(a: list[float], b: list[float]) -> float:
+    dot = sum(x * y for x, y in zip(a, b))
+    norm = math.sqrt(sum(x * x for x in a)) * math.sqrt(sum(y * y for y in b))
+    return dot / norm if norm else 0.0
+
+
+def load_semantic_cache() -> list[dict]:
+    if not os.path.exists(MAGENTIC_CACHE_FILE):
+        return []
+    with open(MAGENTIC_CACHE_FILE) as f:
+        return json.load(f)
+
+
+def semantic_cache_get(embedding: list[float]) -> dict | None:
+    """Return the most similar cached entry above the threshold, if any."""
+    best, best_score = None, MAGENTIC_CACHE_THRESHOLD
+    for entry in load_semantic_cache():
+        score = cosine_similarity(embedding, entry["embedding"])
+        if score >= best_score:
+            best, best_score = entry, score
+    return best
+
+
+def semantic_cache_put(task: str, embedding: list[float], answer: str) -> None:
+    entries = load_semantic_cache()
+    entries.append({"task": task, "embedding": embedding, "answer": answer})
+    with open(MAGENTIC_CACHE_FILE, "w") as f:
+        json.dump(entries, f)
+
+
+async def embed_task(task: str) -> list[float]:
+    client, _ = get_openai_client()
+    embedding_service = OpenAITextEmbedding(ai_model_id=EMBEDDING_MODEL_ID, async_client=client)
+    embeddings = await embedding_service.generate_embeddings([task])
+    return [float(x) for x in embeddings[0]]
+
+
+# Local response caches for chat services, stored in one sqlite file with a table per
+# service role, a TTL and an LRU bound on the number of entries.
+CHAT_CACHE_DB = os.environ.get("CHAT_CACHE_DB", ".chat_cache.sqlite")
+CHAT_CACHE_MAX_ENTRIES = int(os.getenv("CHAT_CACHE_MAX_ENTRIES", "1000"))
+SEARCH_CACHE_TTL = int(os.getenv("SEARCH_CACHE_TTL", "86400"))
+MANAGER_CACHE_TTL = int(os.getenv("MANAGER_CACHE_TTL", "86400"))
+CODER_CACHE_TTL = int(os.getenv("CODER_CACHE_TTL", "86400"))
+
+
+def chat_history_key(chat_history: ChatHistory, settings=None, kernel=None) -> str:
+    # The orchestration ends every agent request with a generic "Transferred to ..."
+    # message, so the key covers the whole conversation rather than the last turn only.
+    # Messages are serialized as sent to the API, together with the execution settings
+    # (response format, temperature, ...) and the available tools, so only an identical
+    # request matches.
+    request = {
+        "messages": [m.to_dict() for m in chat_history.messages],
+        "settings": settings.model_dump(exclude_none=True) if settings is not None else None,
+        "function_choice": repr(getattr(settings, "function_choice_behavior", None)),
+        "tools": sorted(f.fully_qualified_name for f in kernel.get_full_list_of_function_metadata()) if kernel else [],
+    }
+    serialized = json.dumps(request, sort_keys=True, default=str)
+    return hashlib.sha256(serialized.encode()).hexdigest()
+
+
+def open_chat_cache(table: str) -> sqlite3.Connection:
+    db = sqlite3.connect(CHAT_CACHE_DB)
+    db.execute(f"CREATE TABLE IF NOT EXISTS {table} (key TEXT PRIMARY KEY, value TEXT, expires REAL, last_used REAL)")
+    return db
+
+
+def chat_cache_get(table: str, key: str) -> str | None:
+    now = time.time()
+    with closing(open_chat_cache(table)) as db, db:
+        row = db.execute(f"SELECT value FROM {table} WHERE key = ? AND expires > ?", (key, now)).fetchone()
+        if row is None:
+            return None
+        db.execute(f"UPDATE {table} SET last_used = ? WHERE key = ?", (now, key))
+        return row[0]
+
+
+def chat_cache_put(table: str, key: str, value: str, ttl: int) -> None:
+    now = time.time()
+    with closing(open_chat_cache(table)) as db, db:
+        db.execute(f"INSERT OR REPLACE INTO {table} VALUES (?, ?, ?, ?)", (key, value, now + ttl, now))
+        db.execute(f"DELETE FROM {table} WHERE expires <= ?", (now,))
+        db.execute(
+            f"DELETE FROM {table} WHERE key NOT IN (SELECT key FROM {table} ORDER BY last_used DESC LIMIT ?)",
+            (CHAT_CACHE_MAX_ENTRIES,),
+        )
+
+
+_inflight_requests: dict[str, asyncio.Future[list[ChatMessageContent]]] = {}
+
+
+class CachedChatCompletion(OpenAIChatCompletion):
+    """OpenAIChatCompletion that answers repeated conversations from the local chat cache.
+
+    With `use_cache=False` the cache is neither read nor written.
+    """
+
+    cache_table: ClassVar[str]
+    cache_ttl: ClassVar[int]
+    use_cache: bool = True
+
+    def __init__(self, *, use_cache: bool = True, **kwargs) -> None:
+        # OpenAIChatCompletion.__init__ has a fixed signature, so set the field afterwards
+        super().__init__(**kwargs)
+        self.use_cache = use_cache
+
+    async def get_chat_message_contents(self, chat_history, settings, **kwargs) -> list[ChatMessageContent]:
+        key = chat_history_key(chat_history, settings, kwargs.get("kernel"))
+        cached = chat_cache_get(self.cache_table, key) if self.use_cache else None
+        if cached is not None:
+            return [ChatMessageContent(role=AuthorRole.ASSISTANT, content=cached, ai_model_id=self.ai_model_id)]
+
+        # Single-flight: concurrent identical requests (e.g. the same task planned twice in a
+        # batch) share one HTTP call; each caller gets its own copy of the messages.
+        inflight_key = f"{self.cache_table}:{key}"
+        request = _inflight_requests.get(inflight_key)
+        if request is None:
+            request = asyncio.ensure_future(self._complete_and_cache(key, chat_history, settings, **kwargs))
+            _inflight_requests[inflight_key] = request
+            request.add_done_callback(lambda _: _inflight_requests.pop(inflight_key, None))
+        results = await asyncio.shield(request)
+        return [message.model_copy(deep=True) for message in results]
+
+    async def get_streaming_chat_message_contents(self, chat_history, settings, **kwargs):
+        # Agents invoked through invoke_stream (as current orchestration actors do) come
+        # through here rather than get_chat_message_contents.
+        key = chat_history_key(chat_history, settings, kwargs.get("kernel"))
+        cached = chat_cache_get(self.cache_table, key) if self.use_cache else None
+        inflight_key = f"{self.cache_table}:{key}"
+        if cached is None and inflight_key in _inflight_requests:
+            results = await asyncio.shield(_inflight_requests[inflight_key])
+            cached = results[0].content if results else ""
+        if cached is not None:
+            # A cached or coalesced answer is replayed as a single chunk
+            yield [
+                StreamingChatMessageContent(
+                    role=AuthorRole.ASSISTANT, content=cached, choice_index=0, ai_model_id=self.ai_model_id
+                )
+            ]
+            return
+
+        request: asyncio.Future[list[ChatMessageContent]] = asyncio.get_running_loop().create_future()
+        request.add_done_callback(lambda f: f.cancelled() or f.exception())  # followers may not exist
+        _inflight_requests[inflight_key] = request
+        chunks: list[str] = []
+        try:
+            await get_rate_limiter(self.ai_model_id).acquire(estimate_tokens(chat_history.messages))
+            async for messages in super().get_streaming_chat_message_contents(chat_history, settings, **kwargs):
+                chunks.extend(str(m.content) for m in messages if m.role == AuthorRole.ASSISTANT and m.content)
+                yield messages
+        except Exception as e:
+            request.set_exception(e)
+            raise
+        else:
+            answer = "".join(chunks)
+            if self.use_cache and answer:
+                chat_cache_put(self.cache_table, key, answer, self.cache_ttl)
+            request.set_result(
+                [ChatMessageContent(role=AuthorRole.ASSISTANT, content=answer, ai_model_id=self.ai_model_id)]
+            )
+        finally:
+            _inflight_requests.pop(inflight_key, None)
+            if not request.done():
+                request.cancel()
+
+    async def _complete_and_cache(self, key: str, chat_history, settings, **kwargs) -> list[ChatMessageContent]:
+        await get_rate_limiter(self.ai_model_id).acquire(estimate_tokens(chat_history.messages))
+        results = await super().get_chat_message_contents(chat_history, settings, **kwargs)
+        if self.use_cache and results and results[0].content:
+            chat_cache_put(self.cache_table, key, results[0].content, self.cache_ttl)
+        return results
 
-async def main():
-    """Main function to run the agents."""
-    research_agent = ChatCompletionAgent(
-        name="ResearchAgent",
-        description="A helpful assistant with access to web search. Ask it to perform web searches.",
-        instructions=("You are a Researcher. You find information."),
-        service=OpenAIChatCompletion(ai_model_id="gpt-4o-search-preview"),
-    )
 
-    # Create an OpenAI Assistant agent with code interpreter capability
-    client, model = OpenAIAssistantAgent.setup_resources()
-    code_interpreter_tool, code_interpreter_tool_resources = OpenAIAssistantAgent.configure_code_interpreter_tool()
-    definition = await client.beta.assistants.create(
+class SearchCacheChatCompletion(CachedChatCompletion):
+    """ResearchAgent service: gpt-4o-search-preview searches inside the model call, so
+    the whole search answer is cached for a day."""
+
+    cache_table: ClassVar[str] = "search_cache"
+    cache_ttl: ClassVar[int] = SEARCH_CACHE_TTL
+
+
+class ManagerCacheChatCompletion(CachedChatCompletion):
+    """Manager service: when a task is re-run without a final answer in the semantic
+    cache (e.g. the previous run failed), its facts/plan ledger and any later ledger
+    steps with identical agent replies are replayed instead of re-planned.
+
+    Keys are exact, so any other task is planned from scratch.
+    """
+
+    cache_table: ClassVar[str] = "manager_cache"
+    cache_ttl: ClassVar[int] = MANAGER_CACHE_TTL
+
+
+# Retrieval research: the reference article is fetched, split into rows/paragraphs and
+# embedded once, then cached on disk; lookups are a local top-k cosine search.
+RESEARCH_CORPUS_URL = os.environ.get(
+    "RESEARCH_CORPUS_URL", "https://en.wikipedia.org/api/rest_v1/page/html/List_of_tallest_buildings"
+)
+RESEARCH_INDEX_FILE = os.environ.get("RESEARCH_INDEX_FILE", ".research_index.json")
+RESEARCH_TOP_K = int(os.getenv("RESEARCH_TOP_K", "20"))
+RESEARCH_EMBEDDING_BATCH_SIZE = 256
+_research_index: dict | None = None
+_research_index_lock = asyncio.Lock()
+
+
+def split_article(html: str) -> list[str]:
+    """Split an article's HTML into table rows, paragraphs and list items as plain text."""
+    # Inline CSS/JS is not article text
+    html = re.sub(r"<(style|script)\b[^>]*>.*?</\1\s*>", " ", html, flags=re.DOTALL | re.IGNORECASE)
+    chunks = []
+    for block in re.split(r"</(?:tr|p|li|h\d)>", html):
+        text = " ".join(html_lib.unescape(re.sub(r"<[^>]+>", " ", block)).split())
+        if len(text) > 3:
+            chunks.append(text)
+    return chunks
+
+
+async def build_research_index() -> dict:
+    async with httpx.AsyncClient(timeout=HTTP_TIMEOUT, follow_redirects=True) as http:
+        response = await http.get(RESEARCH_CORPUS_URL)
+        response.raise_for_status()
+    chunks = split_article(response.text)
+    client, _ = get_openai_client()
+    embedding_service = OpenAITextEmbedding(ai_model_id=EMBEDDING_MODEL_ID, async_client=client)
+    # A single embeddings request accepts at most 2048 inputs
+    embeddings = await embedding_service.generate_embeddings(chunks, batch_size=RESEARCH_EMBEDDING_BATCH_SIZE)
+    return {
+        "url": RESEARCH_CORPUS_URL,
+        "chunks": chunks,
+        "embeddings": [[float(x) for x in embedding] for embedding in embeddings],
+    }
+
+
+async def get_research_index() -> dict:
+    global _research_index
+    async with _research_index_lock:
+        if _research_index is None and os.path.exists(RESEARCH_INDEX_FILE):
+            with open(RESEARCH_INDEX_FILE) as f:
+                index = json.load(f)
+            if index["url"] == RESEARCH_CORPUS_URL:
+                _research_index = index
+        if _research_index is None:
+            _research_index = await build_research_index()
+            with open(RESEARCH_INDEX_FILE, "w") as f:
+                json.dump(_research_index, f)
+    return _research_index
+
+
+class RetrievalPlugin:
+    """Search tool for the ResearchAgent in retrieval mode."""
+
+    @kernel_function(description="Search the reference corpus and return the most relevant passages.")
+    async def search(self, query: Annotated[str, "What to look up."]) -> Annotated[str, "Matching passages."]:
+        index = await get_research_index()
+        query_embedding = await embed_task(query)
+        best = heapq.nlargest(
+            RESEARCH_TOP_K,
+            zip(index["embeddings"], index["chunks"]),
+            key=lambda entry: cosine_similarity(query_embedding, entry[0]),
+        )
+        return "\n".join(chunk for _, chunk in best)
+
+
+class RetrievalCacheChatCompletion(CachedChatCompletion):
+    """ResearchAgent service in retrieval mode; cached separately from live search answers."""
+
+    cache_table: ClassVar[str] = "retrieval_cache"
+    cache_ttl: ClassVar[int] = SEARCH_CACHE_TTL
+
+
+# The coder Assistant is a server-side resource: create it once, persist its id and
+# retrieve it on later runs instead of creating a new Assistant per orchestration.
+CODER_ASSISTANT_ID_FILE = os.environ.get("CODER_ASSISTANT_ID_FILE", ".coder_assistant_id")
+_coder_assistant: Assistant | None = None
+_coder_assistant_lock = asyncio.Lock()
+
+
+async def get_or_create_coder_assistant() -> Assistant:
+    """Return the CoderAgent Assistant definition, retrieving a persisted one when available."""
+    global _coder_assistant
+    async with _coder_assistant_lock:
+        if _coder_assistant is None:
+            _coder_assistant = await _retrieve_or_create_coder_assistant()
+    return _coder_assistant
+
+
+async def _retrieve_or_create_coder_assistant() -> Assistant:
+    client, model = get_openai_client()
+    assistant_id = os.getenv("CODER_ASSISTANT_ID")
+    if not assistant_id and os.path.exists(CODER_ASSISTANT_ID_FILE):
+        with open(CODER_ASSISTANT_ID_FILE) as f:
+            assistant_id = f.read().strip()
+
+    if assistant_id:
+        try:
+            return await client.beta.assistants.retrieve(assistant_id)
+        except NotFoundError:
+            pass  # Deleted server-side; create a new one below.
+
+    # Create an OpenAI Assistant with code interpreter capability
+    assistant = await client.beta.assistants.create(
         model=model,
-        name="CoderAgent",
-        description="A helpful assistant with code interpreter capability.",
-        instructions="You solve questions using code.",
-        tools=code_interpreter_tool,
-        tool_resources=code_interpreter_tool_resources,
+        name=CODER_AGENT_NAME,
+        description=CODER_AGENT_DESCRIPTION,
+        instructions=CODER_AGENT_INSTRUCTIONS,
+        tools=CODE_INTERPRETER_TOOL,
+        tool_resources=CODE_INTERPRETER_RESOURCES,
     )
-    coder_agent = OpenAIAssistantAgent(
+    with open(CODER_ASSISTANT_ID_FILE, "w") as f:
+        f.write(assistant.id)
+    return assistant
+
+
+# Assistant threads per session: follow-up tasks in the same session continue the
+# CoderAgent's server-side thread instead of starting a new one each orchestration.
+CODER_THREADS_FILE = os.environ.get("CODER_THREADS_FILE", ".coder_threads.json")
+
+
+def load_coder_threads() -> dict[str, str]:
+    if not os.path.exists(CODER_THREADS_FILE):
+        return {}
+    with open(CODER_THREADS_FILE) as f:
+        return json.load(f)
+
+
+def save_coder_thread(session_id: str, thread_id: str) -> None:
+    threads = load_coder_threads()
+    threads[session_id] = thread_id
+    with open(CODER_THREADS_FILE, "w") as f:
+        json.dump(threads, f)
+
+
+class CoderAssistantAgent(OpenAIAssistantAgent):
+    """OpenAIAssistantAgent for the CoderAgent.
+
+    With a `session_id`, its first turn attaches to the session's persisted thread.
+    Without one, a first turn over a conversation it has already answered is served
+    from the chat cache: the code interpreter runs server-side inside the Assistant
+    run, so the run's answer is what gets cached (unless `use_cache` is off).
+
+    Everything goes through `invoke_stream`, which is what current orchestration actors
+    call; `get_response` and `invoke` (used by older actors) aggregate that stream.
+    """
+
+    session_id: str | None = None
+    use_cache: bool = True
+
+    async def invoke_stream(self, messages=None, *, thread: AgentThread | None = None, **kwargs):
+        if thread is None and self.session_id is not None:
+            stream = self._stream_session(messages, **kwargs)
+        elif thread is None and self.use_cache and isinstance(messages, list):
+            stream = self._stream_cached(messages, **kwargs)
+        else:
+            stream = self._stream_run(messages, thread, **kwargs)
+        async for item in stream:
+            yield item
+
+    async def get_response(self, messages=None, *, thread: AgentThread | None = None, **kwargs):
+        # Code interpreter input is streamed too but is not part of the answer.
+        chunks: list[str] = []
+        async for item in self.invoke_stream(messages=messages, thread=thread, **kwargs):
+            thread = item.thread
+            if item.message.metadata.get("code") is not True and item.message.content:
+                chunks.append(item.message.content)
+        if thread is None or not chunks:
+            raise AgentInvokeException("No response messages were returned from the agent.")
+        return AgentResponseItem(
+            message=ChatMessageContent(
+                role=AuthorRole.ASSISTANT, content="".join(chunks), name=self.name, metadata={"thread_id": thread.id}
+            ),
+            thread=thread,
+        )
+
+    async def invoke(self, messages=None, *, thread: AgentThread | None = None, **kwargs):
+        yield await self.get_response(messages=messages, thread=thread, **kwargs)
+
+    async def _stream_run(self, messages, thread: AgentThread | None = None, **kwargs):
+        batch = messages if isinstance(messages, list) else [messages]
+        await get_rate_limiter(self.definition.model).acquire(estimate_tokens(batch))
+        # The streaming runs API delivers the run's events as they happen instead of
+        # polling the run status until it completes.
+        async for item in super().invoke_stream(messages=messages, thread=thread, **kwargs):
+            yield item
+
+    async def _stream_session(self, messages, **kwargs):
+        thread_id = load_coder_threads().get(self.session_id)
+        if thread_id:
+            started = False
+            try:
+                thread = AssistantAgentThread(client=self.client, thread_id=thread_id)
+                async for item in self._stream_run(messages, thread, **kwargs):
+                    started = True
+                    yield item
+                return
+            except NotFoundError:
+                if started:
+                    raise
+                # Deleted server-side; continue the session on a new thread.
+
+        saved = False
+        async for item in self._stream_run(messages, **kwargs):
+            if not saved:
+                save_coder_thread(self.session_id, item.thread.id)
+                saved = True
+            yield item
+
+    async def _stream_cached(self, messages, **kwargs):
+        history = ChatHistory(
+            messages=[
+                ChatMessageContent(role=AuthorRole.USER, content=message) if isinstance(message, str) else message
+                for message in messages
+            ]
+        )
+        key = chat_history_key(history)
+        cached = chat_cache_get("coder_cache", key)
+        if cached is not None:
+            # The thread is only created if the orchestration comes back to this agent; it
+            # starts from the same conversation plus the cached answer.
+            thread = AssistantAgentThread(
+                client=self.client,
+                messages=[
+                    {"role": "user" if m.role == AuthorRole.USER else "assistant", "content": str(m.content)}
+                    for m in [*history.messages, ChatMessageContent(role=AuthorRole.ASSISTANT, content=cached)]
+                    if m.content
+                ],
+            )
+            yield AgentResponseItem(
+                message=StreamingChatMessageContent(
+                    role=AuthorRole.ASSISTANT, content=cached, name=self.name, choice_index=0
+                ),
+                thread=thread,
+            )
+            return
+
+        chunks: list[str] = []
+        async for item in self._stream_run(messages, **kwargs):
+            if item.message.metadata.get("code") is not True and item.message.content:
+                chunks.append(item.message.content)
+            yield item
+        if chunks:
+            chat_cache_put("coder_cache", key, "".join(chunks), CODER_CACHE_TTL)
+
+
+async def create_agents(session_id: str | None = None, use_cache: bool = True) -> list:
+    """Create a fresh ResearchAgent/CoderAgent pair.
+
+    Every orchestration gets its own agent instances, so orchestrations running
+    concurrently never share agent state; the CoderAgent's server-side Assistant
+    definition is shared, and with a `session_id` so is its thread. `use_cache=False`
+    turns off the agents' response caches.
+    """
+    client, _ = get_openai_client()
+    if RESEARCH_MODE == "search":
+        research_agent = ChatCompletionAgent(
+            name=RESEARCH_AGENT_NAME,
+            description=RESEARCH_AGENT_DESCRIPTION,
+            instructions=RESEARCH_AGENT_INSTRUCTIONS,
+            service=SearchCacheChatCompletion(ai_model_id=RESEARCH_MODEL_ID, async_client=client, use_cache=use_cache),
+        )
+    else:
+        research_agent = ChatCompletionAgent(
+            name=RESEARCH_AGENT_NAME,
+            description=RETRIEVAL_AGENT_DESCRIPTION,
+            instructions=RETRIEVAL_AGENT_INSTRUCTIONS,
+            service=RetrievalCacheChatCompletion(
+                ai_model_id=RETRIEVAL_MODEL_ID, async_client=client, use_cache=use_cache
+            ),
+            plugins=[RetrievalPlugin()],
+        )
+    coder_agent = CoderAssistantAgent(
         client=client,
-        definition=definition,
+        definition=await get_or_create_coder_assistant(),
+        session_id=session_id,
+        use_cache=use_cache,
     )
+    return [research_agent, coder_agent]
+
+
+async def run_orchestration(task: str, session_id: str | None = None, use_cache: bool = True) -> str:
+    """Run the Magentic One orchestration for a task and return its final answer.
 
+    Within one orchestration the manager picks a single next agent per step from the
+    progress ledger, which depends on the previous agent's reply, so agent turns are
+    inherently sequential; independent tasks should run as separate orchestrations.
+    The orchestration parses each ledger as one structured (JSON) response before it
+    dispatches, so streaming the manager's completion would not start an agent earlier.
+    """
     magentic_one_pattern = MagenticOneOrchestration(
-        agents=[research_agent, coder_agent],
-        manager_service=OpenAIChatCompletion(),
-    )
-    await magentic_one_pattern.start(
-        task=(
-            "What are the 50 tallest buildings in the world? Create a table with their names"
-            " and heights grouped by country with a column of the average height of the buildings"
-            " in each country"
+        agents=await create_agents(session_id, use_cache),
+        manager_service=ManagerCacheChatCompletion(
+            ai_model_id=MANAGER_MODEL_ID, async_client=get_openai_client()[0], use_cache=use_cache
         ),
-        runtime=SingleThreadedAgentRuntime(),
     )
+    runtime = runtime_pool.acquire()
+    try:
+        result = await magentic_one_pattern.start(
+            task=task,
+            runtime=runtime,
+        )
+        # start() only schedules the run; the final answer comes from the result handle,
+        # and the runtime stays busy until then.
+        answer = await result.get()
+    except BaseException:
+        # A failed or cancelled run may leave messages in flight; don't hand it out again.
+        await runtime_pool.discard(runtime)
+        raise
+    await runtime_pool.release(runtime)
+    return answer.content if isinstance(answer, ChatMessageContent) else str(answer or "")
+
+
+async def run_task(task: str, use_cache: bool = True, session_id: str | None = None) -> str:
+    """Answer a task from the semantic cache, or run the orchestration and cache the answer.
+
+    `use_cache=False` skips the semantic cache and every response cache below it.
+    """
+    embedding = None
+    if use_cache:
+        # The semantic cache is optional: if the embedding call fails, just run the agents
+        try:
+            embedding = await embed_task(task)
+        except Exception as e:
+            print(f"# Semantic cache disabled, embedding failed: {e}")
+    if embedding is not None:
+        cached = semantic_cache_get(embedding)
+        if cached:
+            print(f"# Semantic cache hit for task: {cached['task']!r}")
+            return cached["answer"]
+
+    answer = await run_orchestration(task, session_id, use_cache)
+    if embedding is not None and answer.strip():
+        semantic_cache_put(task, embedding, answer)
+    return answer
+
+
+async def run_batch(tasks: list[str], concurrency: int = 8, use_cache: bool = True) -> list[str]:
+    """Run several tasks concurrently, at most `concurrency` orchestrations at a time.
+
+    Each task gets its own orchestration and agents (see `create_agents`) and a runtime
+    from the shared pool; answers are returned in the order of `tasks`.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def bounded(task: str) -> str:
+        async with semaphore:
+            return await run_task(task, use_cache=use_cache)
+
+    return await asyncio.gather(*[bounded(task) for task in tasks])
+
+
+async def main(task: str = TASK, use_cache: bool = True, session_id: str | None = None):
+    """Main function to run the agents.
+
+    Safe to call repeatedly on one event loop: the OpenAI client, runtime pool and
+    coder Assistant are reused between calls and released by `shutdown`.
+    """
+    print(await run_task(task, use_cache=use_cache, session_id=session_id))
+
+
+async def shutdown() -> None:
+    await runtime_pool.close()
+    await close_openai_client()
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Run the Magentic One orchestration.")
+    parser.add_argument("--no-cache", action="store_true", help="Skip all caches and always run the agents.")
+    parser.add_argument("--session", help="Continue the CoderAgent thread of this session across runs.")
+    args = parser.parse_args()
+
+    # Logging is only configured when run as a script. Records go through a queue and are
+    # written to stderr by a listener thread, so log I/O never blocks the event loop.
+    log_queue = queue.SimpleQueue()
+    log_handler = logging.StreamHandler()
+    log_handler.setFormatter(logging.Formatter(logging.BASIC_FORMAT))
+    log_listener = logging.handlers.QueueListener(log_queue, log_handler)
+    logging.basicConfig(level=logging.WARNING, handlers=[logging.handlers.QueueHandler(log_queue)])
+    logging.getLogger("semantic_kernel.agents.orchestration.magentic_one").setLevel(
+        logging.DEBUG
+    )  # Enable DEBUG for group chat pattern
+    log_listener.start()
+
+    # One long-lived loop (uvloop when installed) for the whole process
+    loop = uvloop.new_event_loop() if uvloop is not None else asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        loop.run_until_complete(main(use_cache=not args.no_cache, session_id=args.session))
+    finally:
+        loop.run_until_complete(shutdown())
+        loop.close()
+        log_listener.stop()